@@ -1,17 +1,21 @@
 # agents/aggregator/app.py - Results aggregation agent
 import time
 import asyncio
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Sequence
 import numpy as np
+from numba import vectorize
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import structlog
 import httpx
 
+from utils.tensors import encode_tensor, decode_tensor
+
 logger = structlog.get_logger()
 
-app = FastAPI(title="Aggregator Agent", version="1.0.0")
+app = FastAPI(title="Aggregator Agent", version="1.0.0", default_response_class=ORJSONResponse)
 
 class AggregationRequest(BaseModel):
     results: List[Dict[str, Any]]
@@ -23,9 +27,26 @@ class AggregatedResponse(BaseModel):
     metadata: Dict[str, Any]
     individual_results: List[Dict[str, Any]]
 
+@vectorize(['f4(f4)'], target='cpu')
+def _inverse_time_confidence(exec_time):
+    """Inverse of execution time as a confidence proxy (+1 avoids division by zero)"""
+    return 1.0 / (exec_time + 1.0)
+
+def _as_array(value: Any) -> np.ndarray:
+    """Decode a binary tensor payload from the coordinator (plain lists are still accepted)"""
+    if isinstance(value, dict) and 'b64' in value:
+        return decode_tensor(value['b64'], value['shape'], value['datatype'])
+    return np.asarray(value)
+
 class AggregatorAgent:
     def __init__(self, coordinator_url: str):
         self.coordinator_url = coordinator_url
+        # Shared client so coordinator calls reuse pooled keep-alive connections
+        self.http = httpx.AsyncClient(
+            base_url=f"http://{coordinator_url}",
+            timeout=2.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+        )
         self.aggregation_strategies = {
             'default': self._default_aggregation,
             'ensemble': self._ensemble_aggregation,
@@ -43,8 +64,13 @@ class AggregatorAgent:
             if strategy not in self.aggregation_strategies:
                 strategy = 'default'
             
+            # Decode every output once into an (N, *shape) FP32 stack shared by the strategies
+            stacks = {}
+            if strategy != 'default' and len(request.results) > 1:
+                stacks = self._stack_outputs(request.results)
+            
             aggregation_func = self.aggregation_strategies[strategy]
-            aggregated = await aggregation_func(request.results, request.weights)
+            aggregated = await aggregation_func(request.results, stacks, request.weights)
             
             return AggregatedResponse(
                 aggregated_results=aggregated,
@@ -61,7 +87,19 @@ class AggregatorAgent:
             logger.error("Aggregation failed", error=str(e))
             raise HTTPException(500, f"Aggregation failed: {str(e)}")
     
-    async def _default_aggregation(self, results: List[Dict], weights: Optional[List[float]]) -> Dict[str, Any]:
+    def _stack_outputs(self, results: List[Dict]) -> Dict[str, np.ndarray]:
+        """Stack each output present in every result along a new leading axis"""
+        return {
+            output_name: np.stack(
+                [np.asarray(_as_array(result['outputs'][output_name]), dtype=np.float32) for result in results],
+                axis=0
+            )
+            for output_name in results[0]['outputs']
+            if all(output_name in result['outputs'] for result in results)
+        }
+    
+    async def _default_aggregation(self, results: List[Dict], stacks: Dict[str, np.ndarray],
+                                   weights: Optional[List[float]]) -> Dict[str, Any]:
         """Simple majority vote or average aggregation"""
         if len(results) == 1:
             return results[0]['outputs']
@@ -69,95 +107,76 @@ class AggregatorAgent:
         # For multiple results, take the first one (can be enhanced)
         return results[0]['outputs']
     
-    async def _ensemble_aggregation(self, results: List[Dict], weights: Optional[List[float]]) -> Dict[str, Any]:
+    async def _ensemble_aggregation(self, results: List[Dict], stacks: Dict[str, np.ndarray],
+                                    weights: Optional[List[float]]) -> Dict[str, Any]:
         """Ensemble aggregation for classification results"""
         if len(results) == 1:
             return results[0]['outputs']
         
-        # Combine outputs by averaging
-        combined_outputs = {}
-        
-        # Get output names from first result
-        output_names = list(results[0]['outputs'].keys())
-        
-        for output_name in output_names:
-            output_arrays = []
-            for result in results:
-                if output_name in result['outputs']:
-                    output_data = np.array(result['outputs'][output_name])
-                    output_arrays.append(output_data)
-            
-            if output_arrays:
-                # Average the outputs
-                ensemble_output = np.mean(output_arrays, axis=0)
-                combined_outputs[output_name] = ensemble_output.tolist()
-        
-        return combined_outputs
+        # Combine outputs by averaging over the results axis
+        return {
+            output_name: encode_tensor(stack.mean(axis=0, dtype=np.float32))
+            for output_name, stack in stacks.items()
+        }
     
-    async def _weighted_aggregation(self, results: List[Dict], weights: Optional[List[float]]) -> Dict[str, Any]:
+    async def _weighted_aggregation(self, results: List[Dict], stacks: Dict[str, np.ndarray],
+                                    weights: Optional[Sequence[float]]) -> Dict[str, Any]:
         """Weighted aggregation based on provided weights"""
-        if not weights or len(weights) != len(results):
+        if weights is None or len(weights) != len(results):
             # Fallback to ensemble if weights are invalid
-            return await self._ensemble_aggregation(results, weights)
+            return await self._ensemble_aggregation(results, stacks, weights)
         
         if len(results) == 1:
             return results[0]['outputs']
         
         # Normalize weights
-        weights = np.array(weights)
-        weights = weights / np.sum(weights)
-        
-        combined_outputs = {}
-        output_names = list(results[0]['outputs'].keys())
+        weights = np.asarray(weights, dtype=np.float32)
+        weights /= weights.sum()
         
-        for output_name in output_names:
-            weighted_sum = None
-            
-            for i, result in enumerate(results):
-                if output_name in result['outputs']:
-                    output_data = np.array(result['outputs'][output_name])
-                    weighted_output = output_data * weights[i]
-                    
-                    if weighted_sum is None:
-                        weighted_sum = weighted_output
-                    else:
-                        weighted_sum += weighted_output
-            
-            if weighted_sum is not None:
-                combined_outputs[output_name] = weighted_sum.tolist()
-        
-        return combined_outputs
+        # Single contraction over the results axis per output
+        return {
+            output_name: encode_tensor(np.tensordot(weights, stack, axes=1))
+            for output_name, stack in stacks.items()
+        }
     
-    async def _confidence_based_aggregation(self, results: List[Dict], weights: Optional[List[float]]) -> Dict[str, Any]:
+    async def _confidence_based_aggregation(self, results: List[Dict], stacks: Dict[str, np.ndarray],
+                                            weights: Optional[List[float]]) -> Dict[str, Any]:
         """Aggregation based on confidence scores"""
         if len(results) == 1:
             return results[0]['outputs']
         
-        # Extract confidence scores or use execution time as proxy
-        confidences = []
-        for result in results:
-            metadata = result.get('metadata', {})
-            # Use inverse of execution time as confidence proxy
-            exec_time = metadata.get('execution_time_ms', 1000)
-            confidence = 1.0 / (exec_time + 1)  # Avoid division by zero
-            confidences.append(confidence)
+        # Use inverse of execution time as confidence proxy
+        exec_times = np.fromiter(
+            (result.get('metadata', {}).get('execution_time_ms', 1000) for result in results),
+            dtype=np.float32,
+            count=len(results)
+        )
+        confidences = _inverse_time_confidence(exec_times)
         
         # Use confidences as weights
-        return await self._weighted_aggregation(results, confidences)
+        return await self._weighted_aggregation(results, stacks, confidences)
     
     async def query_coordinator_status(self) -> Dict[str, Any]:
         """Query coordinator for status information"""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"http://{self.coordinator_url}/status")
-                return response.json()
+            response = await self.http.get("/status")
+            return response.json()
         except Exception as e:
             logger.warning(f"Failed to query coordinator: {e}")
             return {"status": "unknown", "error": str(e)}
+    
+    async def close(self):
+        """Close pooled HTTP connections"""
+        await self.http.aclose()
 
 # Global agent instance
 aggregator = AggregatorAgent(coordinator_url="inference-coordinator:8080")
 
+@app.on_event("shutdown")
+async def shutdown():
+    """Release the agent's HTTP connections on shutdown"""
+    await aggregator.close()
+
 @app.post("/aggregate")
 async def aggregate_results(request: AggregationRequest):
     """Aggregate multiple inference results"""
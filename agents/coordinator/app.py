@@ -1,17 +1,22 @@
 # agents/coordinator/app.py - Agentic inference coordinator
 import asyncio
+import hashlib
 import logging
+import math
 import os
 import time
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Union
 import numpy as np
 
-import tritonclient.http as httpclient
+from cachetools import TTLCache
+import tritonclient.grpc.aio as grpcclient
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 import structlog
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
-from fastapi.responses import Response
+from fastapi.responses import ORJSONResponse, Response
+
+from utils.tensors import TRITON_TO_NP_DTYPE, encode_tensor, decode_tensor
 
 # Configure structured logging
 logging.basicConfig(level=logging.INFO)
@@ -22,12 +27,26 @@ REQUEST_COUNT = Counter('inference_requests_total', 'Total inference requests',
 REQUEST_DURATION = Histogram('inference_request_duration_seconds', 'Request duration', ['model'])
 GPU_UTILIZATION = Gauge('gpu_utilization_percent', 'GPU utilization percentage')
 MODEL_AVAILABILITY = Gauge('model_availability', 'Model availability status', ['model'])
+CACHE_HITS = Counter('inference_cache_hits_total', 'Inference cache hits', ['model'])
+
+# Per-request cache modes (request.parameters['cache'])
+CACHE_MODES = ('on', 'read_only', 'write_only', 'off')
+
+app = FastAPI(title="AI Inference Coordinator Agent", version="1.0.0", default_response_class=ORJSONResponse)
 
-app = FastAPI(title="AI Inference Coordinator Agent", version="1.0.0")
+class BinaryTensor(BaseModel):
+    b64: str
+    shape: List[int]
+    datatype: Optional[str] = None
+
+class ListTensor(BaseModel):
+    data: List[Any]
+    shape: Optional[List[int]] = None
+    datatype: Optional[str] = None
 
 class InferenceRequest(BaseModel):
     model_name: str
-    inputs: Dict[str, Any]
+    inputs: Dict[str, Union[BinaryTensor, ListTensor, List[Any]]]
     parameters: Optional[Dict[str, Any]] = None
 
 class AgentStatus(BaseModel):
@@ -37,29 +56,42 @@ class AgentStatus(BaseModel):
     gpu_available: bool
 
 class Agent:
-    def __init__(self, triton_url: str):
+    def __init__(self, triton_url: str, enable_batching: bool = True, max_batch_delay_ms: float = 5.0,
+                 cache_size: int = 1024, cache_ttl: float = 300.0):
         self.triton_url = triton_url
         self.client = None
         self.model_metadata = {}
+        self.requested_outputs: Dict[str, List[grpcclient.InferRequestedOutput]] = {}
         self.start_time = time.time()
         self.health_status = "initializing"
+        self.enable_batching = enable_batching
+        self.max_batch_delay = max_batch_delay_ms / 1000.0
+        self.model_queues: Dict[str, asyncio.Queue] = {}
+        self.model_tasks: Dict[str, asyncio.Task] = {}
+        self.batch_tasks: set = set()
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl) if cache_size > 0 else None
         
     async def initialize(self):
         """Discover available models and their capabilities"""
         max_retries = 5
         retry_delay = 5
         
+        # One client for every attempt; the gRPC channel reconnects on its own
+        if self.client is None:
+            self.client = grpcclient.InferenceServerClient(url=self.triton_url)
+        
         for attempt in range(max_retries):
             try:
-                self.client = httpclient.InferenceServerClient(url=self.triton_url)
-                
                 # Test connection
-                if not self.client.is_server_ready():
+                if not await self.client.is_server_ready():
                     raise Exception("Triton server not ready")
                 
                 # Load model metadata
                 await self._load_model_metadata()
                 
+                # Start a batching model loop for every model that accepts batched requests
+                self._start_model_loops()
+                
                 self.health_status = "healthy"
                 logger.info("Agent initialized successfully", models_count=len(self.model_metadata))
                 return
@@ -76,21 +108,30 @@ class Agent:
     async def _load_model_metadata(self):
         """Load metadata for all available models"""
         try:
-            models = self.client.get_model_repository_index()
+            repository_index = await self.client.get_model_repository_index()
             self.model_metadata = {}
+            self.requested_outputs = {}
             
-            for model in models:
+            for model in repository_index.models:
                 if model.state == "READY":
                     try:
-                        metadata = self.client.get_model_metadata(model.name)
+                        metadata = await self.client.get_model_metadata(model.name)
+                        model_config = await self.client.get_model_config(model.name)
                         self.model_metadata[model.name] = {
-                            'inputs': [{'name': inp.name, 'datatype': inp.datatype, 'shape': inp.shape} 
+                            'inputs': [{'name': inp.name, 'datatype': inp.datatype, 'shape': list(inp.shape)} 
                                      for inp in metadata.inputs],
-                            'outputs': [{'name': out.name, 'datatype': out.datatype, 'shape': out.shape} 
+                            'outputs': [{'name': out.name, 'datatype': out.datatype, 'shape': list(out.shape)} 
                                       for out in metadata.outputs],
+                            'input_names': [inp.name for inp in metadata.inputs],
+                            'input_datatypes': [inp.datatype for inp in metadata.inputs],
+                            'output_names': [out.name for out in metadata.outputs],
                             'platform': metadata.platform,
-                            'max_batch_size': getattr(metadata, 'max_batch_size', 0)
+                            'max_batch_size': model_config.config.max_batch_size
                         }
+                        # Requested outputs never change for a model; build them once and reuse per request
+                        self.requested_outputs[model.name] = [
+                            grpcclient.InferRequestedOutput(out.name) for out in metadata.outputs
+                        ]
                         MODEL_AVAILABILITY.labels(model=model.name).set(1)
                         logger.info("Loaded model metadata", model=model.name, platform=metadata.platform)
                     except Exception as e:
@@ -101,6 +142,142 @@ class Agent:
             logger.error(f"Failed to load model metadata: {e}")
             raise
 
+    def _start_model_loops(self):
+        """Spawn a batching model loop per model that can batch requests"""
+        if not self.enable_batching:
+            return
+        
+        for model_name, model_info in self.model_metadata.items():
+            # Models without a batch dimension call Triton directly from each request
+            max_batch_size = model_info['max_batch_size']
+            if model_name in self.model_tasks or max_batch_size <= 1:
+                continue
+            
+            queue = asyncio.Queue()
+            self.model_queues[model_name] = queue
+            self.model_tasks[model_name] = asyncio.create_task(self._model_loop(model_name, queue, max_batch_size))
+            logger.info("Started model loop", model=model_name, max_batch_size=max_batch_size)
+
+    async def _model_loop(self, model_name: str, queue: asyncio.Queue, max_batch_size: int):
+        """Drain queued requests, batching until the batch is full or the delay expires"""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_batch_delay
+            
+            while len(batch) < max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                self._dispatch_batch(model_name, batch, max_batch_size)
+            except Exception as e:
+                logger.error("Model loop failed", model=model_name, error=str(e))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _dispatch_batch(self, model_name: str, batch: List[tuple], max_batch_size: int):
+        """Bucket a drained batch by compatibility and launch one Triton call per full group"""
+        buckets: Dict[tuple, List[tuple]] = {}
+        
+        for item in batch:
+            input_arrays, future = item
+            if future.done():
+                continue
+            
+            # A request that cannot be batched fails on its own, not with the rest of the batch
+            try:
+                key, rows = self._batch_key(input_arrays)
+            except ValueError as e:
+                future.set_exception(e)
+                continue
+            
+            buckets.setdefault(key, []).append((item, rows))
+        
+        # Split each bucket into groups of at most max_batch_size rows
+        for items in buckets.values():
+            group, group_rows = [], 0
+            for item, rows in items:
+                if group and group_rows + rows > max_batch_size:
+                    self._launch_group(model_name, group)
+                    group, group_rows = [], 0
+                group.append(item)
+                group_rows += rows
+            self._launch_group(model_name, group)
+
+    @staticmethod
+    def _batch_key(input_arrays: Dict[str, tuple]) -> tuple:
+        """Grouping key (non-batch dims and datatypes) and row count of one request"""
+        leading = {data.shape[:1] for data, _ in input_arrays.values()}
+        if len(leading) != 1 or () in leading:
+            raise ValueError("inputs must share a leading batch dimension")
+        
+        # Requests can only share a Triton call if all non-batch dims match
+        key = tuple((name, data.shape[1:], datatype) for name, (data, datatype) in sorted(input_arrays.items()))
+        return key, leading.pop()[0]
+
+    def _launch_group(self, model_name: str, group: List[tuple]):
+        """Run a group's Triton call as its own task so the loop can keep collecting"""
+        task = asyncio.create_task(self._infer_group(model_name, group))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def _infer_group(self, model_name: str, group: List[tuple]):
+        """Run one Triton call for a group of requests and fan results back out"""
+        try:
+            if len(group) == 1:
+                stacked = group[0][0]
+            else:
+                stacked = {
+                    name: (np.concatenate([item[0][name][0] for item in group], axis=0), datatype)
+                    for name, (_, datatype) in group[0][0].items()
+                }
+            
+            outputs = await self._infer(model_name, stacked)
+            
+            # Slice every output back along the batch axis for each caller
+            offset = 0
+            for input_arrays, future in group:
+                rows = next(iter(input_arrays.values()))[0].shape[0]
+                if not future.done():
+                    future.set_result({name: data[offset:offset + rows] for name, data in outputs.items()})
+                offset += rows
+                
+        except Exception as e:
+            logger.error("Batched inference failed", model=model_name, batch_size=len(group), error=str(e))
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _infer(self, model_name: str, input_arrays: Dict[str, tuple]) -> Dict[str, np.ndarray]:
+        """Execute a single Triton inference call and return outputs as numpy arrays"""
+        model_info = self.model_metadata[model_name]
+        
+        inputs = []
+        for input_name, (data, datatype) in input_arrays.items():
+            input_tensor = grpcclient.InferInput(input_name, list(data.shape), datatype)
+            input_tensor.set_data_from_numpy(data)
+            inputs.append(input_tensor)
+        
+        result = await self.client.infer(model_name, inputs, outputs=self.requested_outputs[model_name])
+        
+        return {output_name: result.as_numpy(output_name) for output_name in model_info['output_names']}
+
+    def _cache_key(self, model_name: str, input_arrays: Dict[str, tuple]) -> bytes:
+        """Content-addressed cache key over model name and raw input tensors"""
+        hasher = hashlib.blake2b(model_name.encode())
+        for input_name, (data, datatype) in sorted(input_arrays.items()):
+            hasher.update(f"{input_name}:{datatype}:{data.shape}".encode())
+            hasher.update(np.ascontiguousarray(data).data)
+        return hasher.digest()
+
     async def route_inference(self, request: InferenceRequest) -> Dict[str, Any]:
         """Intelligent routing based on model capabilities and load"""
         start_time = time.time()
@@ -114,45 +291,76 @@ class Agent:
             model_info = self.model_metadata[request.model_name]
             
             # Prepare inputs for Triton
-            inputs = []
-            for input_spec in model_info['inputs']:
-                input_name = input_spec['name']
+            input_arrays = {}
+            for input_name, default_datatype in zip(model_info['input_names'], model_info['input_datatypes']):
                 if input_name not in request.inputs:
                     raise HTTPException(400, f"Missing required input: {input_name}")
                 
                 input_data = request.inputs[input_name]
+                datatype = getattr(input_data, 'datatype', None) or default_datatype
+                if datatype not in TRITON_TO_NP_DTYPE:
+                    raise HTTPException(400, f"Unsupported datatype for {input_name}: {datatype}")
+                dtype = TRITON_TO_NP_DTYPE[datatype]
                 
-                # Handle different input formats
-                if isinstance(input_data, dict):
-                    data = np.array(input_data.get('data', input_data))
-                    shape = input_data.get('shape', data.shape)
-                    datatype = input_data.get('datatype', input_spec['datatype'])
-                else:
-                    data = np.array(input_data)
-                    shape = data.shape
-                    datatype = input_spec['datatype']
+                # Handle different input formats; malformed tensors are client errors
+                try:
+                    if isinstance(input_data, BinaryTensor):
+                        # Binary tensor payload: raw bytes plus shape and datatype
+                        data = decode_tensor(input_data.b64, input_data.shape, datatype)
+                    elif isinstance(input_data, ListTensor):
+                        data = np.asarray(input_data.data, dtype=dtype)
+                        if input_data.shape is not None:
+                            if data.size != math.prod(input_data.shape):
+                                raise ValueError(f"{data.size} values do not fit shape {input_data.shape}")
+                            data = data.reshape(input_data.shape)
+                    else:
+                        data = np.asarray(input_data, dtype=dtype)
+                except (ValueError, TypeError) as e:
+                    raise HTTPException(400, f"Invalid tensor for {input_name}: {e}")
                 
-                input_tensor = httpclient.InferInput(input_name, shape, datatype)
-                input_tensor.set_data_from_numpy(data)
-                inputs.append(input_tensor)
+                input_arrays[input_name] = (data, datatype)
             
-            # Prepare outputs
-            outputs = []
-            for output_spec in model_info['outputs']:
-                output = httpclient.InferRequestedOutput(output_spec['name'])
-                outputs.append(output)
+            # Batched models concatenate requests along axis 0
+            if request.model_name in self.model_queues:
+                try:
+                    self._batch_key(input_arrays)
+                except ValueError as e:
+                    raise HTTPException(400, f"Invalid inputs for batched model {request.model_name}: {e}")
             
-            # Execute inference with monitoring
-            inference_start = time.time()
-            result = self.client.infer(request.model_name, inputs, outputs=outputs)
-            inference_time = time.time() - inference_start
+            # Serve byte-identical requests from the result cache
+            cache_mode = (request.parameters or {}).get('cache', 'on')
+            if cache_mode not in CACHE_MODES:
+                raise HTTPException(400, f"Invalid cache mode: {cache_mode}")
+            if self.cache is None:
+                cache_mode = 'off'
             
-            # Process results
-            response_outputs = {}
-            for output_spec in model_info['outputs']:
-                output_name = output_spec['name']
-                output_data = result.as_numpy(output_name)
-                response_outputs[output_name] = output_data.tolist()
+            cache_key = self._cache_key(request.model_name, input_arrays) if cache_mode != 'off' else None
+            response_outputs = self.cache.get(cache_key) if cache_mode in ('on', 'read_only') else None
+            cache_hit = response_outputs is not None
+            
+            if cache_hit:
+                CACHE_HITS.labels(model=request.model_name).inc()
+                inference_time = 0.0
+            else:
+                # Execute inference with monitoring
+                inference_start = time.time()
+                queue = self.model_queues.get(request.model_name)
+                if queue is not None:
+                    # Hand off to the model loop and wait for our slice of the batch
+                    future = asyncio.get_running_loop().create_future()
+                    await queue.put((input_arrays, future))
+                    result_outputs = await future
+                else:
+                    result_outputs = await self._infer(request.model_name, input_arrays)
+                inference_time = time.time() - inference_start
+                
+                # Process results
+                response_outputs = {}
+                for output_name, output_data in result_outputs.items():
+                    response_outputs[output_name] = encode_tensor(output_data)
+                
+                if cache_mode in ('on', 'write_only'):
+                    self.cache[cache_key] = response_outputs
             
             execution_time = time.time() - start_time
             
@@ -166,6 +374,7 @@ class Agent:
                 'metadata': {
                     'execution_time_ms': int(execution_time * 1000),
                     'inference_time_ms': int(inference_time * 1000),
+                    'cache_hit': cache_hit,
                     'agent_id': 'coordinator-001',
                     'timestamp': time.time()
                 }
@@ -185,37 +394,56 @@ class Agent:
             logger.error("Inference failed", model=request.model_name, error=str(e))
             raise HTTPException(500, f"Inference failed: {str(e)}")
 
-    def get_status(self) -> AgentStatus:
+    async def get_status(self) -> AgentStatus:
         """Get current agent status"""
         uptime = time.time() - self.start_time
         return AgentStatus(
             status=self.health_status,
             models_loaded=len(self.model_metadata),
             uptime_seconds=uptime,
-            gpu_available=self._check_gpu_availability()
+            gpu_available=await self._check_gpu_availability()
         )
     
-    def _check_gpu_availability(self) -> bool:
+    async def _check_gpu_availability(self) -> bool:
         """Check if GPU is available"""
         try:
-            if self.client and self.client.is_server_ready():
+            if self.client and await self.client.is_server_ready():
                 return True
         except:
             pass
         return False
 
+    async def close(self):
+        """Stop model loops and in-flight batches, then close the Triton channel"""
+        for task in [*self.model_tasks.values(), *self.batch_tasks]:
+            task.cancel()
+        if self.client:
+            await self.client.close()
+
 # Global agent instance
-coordinator = Agent(triton_url=f"http://{os.getenv('TRITON_URL', 'triton-server:8000')}")
+coordinator = Agent(
+    triton_url=os.getenv('TRITON_GRPC_URL', 'triton-server:8001'),
+    enable_batching=os.getenv('ENABLE_BATCHING', 'true').lower() == 'true',
+    max_batch_delay_ms=float(os.getenv('BATCH_MAX_DELAY_MS', '5')),
+    cache_size=int(os.getenv('INFERENCE_CACHE_SIZE', '1024')),
+    cache_ttl=float(os.getenv('INFERENCE_CACHE_TTL', '300'))
+)
 
 @app.on_event("startup")
 async def startup():
     """Initialize the agent on startup"""
     await coordinator.initialize()
 
+@app.on_event("shutdown")
+async def shutdown():
+    """Release Triton connections on shutdown"""
+    await coordinator.close()
+
 @app.post("/infer")
 async def infer(request: InferenceRequest):
     """Execute inference request"""
-    return await coordinator.route_inference(request)
+    # Response is already plain JSON types; skip FastAPI's recursive jsonable_encoder pass
+    return ORJSONResponse(await coordinator.route_inference(request))
 
 @app.get("/models")
 async def list_models():
@@ -228,7 +456,7 @@ async def list_models():
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    status = coordinator.get_status()
+    status = await coordinator.get_status()
     return {
         "status": status.status,
         "agent": "inference-coordinator",
@@ -240,7 +468,7 @@ async def health():
 @app.get("/status")
 async def get_status():
     """Detailed status information"""
-    return coordinator.get_status()
+    return await coordinator.get_status()
 
 @app.get("/metrics")
 async def metrics():
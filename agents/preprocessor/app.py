@@ -1,19 +1,31 @@
 # agents/preprocessor/app.py - Data preprocessing agent
 import io
+import asyncio
 import base64
 import numpy as np
-from typing import Dict, Any, Optional
-from PIL import Image
+from typing import Dict, List, Any, Optional
 import librosa
 import cv2
 
 from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import structlog
 
+from utils.tensors import encode_tensor
+
 logger = structlog.get_logger()
 
-app = FastAPI(title="Preprocessing Agent", version="1.0.0")
+app = FastAPI(title="Preprocessing Agent", version="1.0.0", default_response_class=ORJSONResponse)
+
+# ImageNet normalisation (x / 255 - mean) / std folded into one scale and one shift
+_IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+_IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+_INV_STD_255 = 1.0 / (_IMAGENET_STD * 255.0)
+_MEAN_OVER_STD = _IMAGENET_MEAN / _IMAGENET_STD
+
+# Whisper expects 30 seconds of audio at 16kHz
+_WHISPER_TARGET_LENGTH = 30 * 16000
 
 class PreprocessRequest(BaseModel):
     data_type: str  # 'text', 'image', 'audio'
@@ -25,15 +37,37 @@ class PreprocessResponse(BaseModel):
     preprocessed_data: Dict[str, Any]
     metadata: Dict[str, Any]
 
+def _decode_image(data: str) -> np.ndarray:
+    """Decode a base64 image straight into an RGB uint8 array"""
+    image = cv2.imdecode(np.frombuffer(base64.b64decode(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Unsupported or corrupt image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def _mock_token_ids(tokens: List[str]) -> np.ndarray:
+    """Stable mock token ids: polynomial hash of each token's UTF-8 bytes, mod 50000"""
+    data = np.frombuffer(' '.join(tokens).encode('utf-8'), dtype=np.uint8)
+    if data.size == 0:
+        return np.zeros(0, dtype=np.int32)
+    
+    # Tokens are separated by single spaces; find each byte's token and offset within it
+    is_space = data == 0x20
+    starts = np.concatenate(([0], np.flatnonzero(is_space) + 1))
+    offsets = np.arange(data.size) - starts[np.cumsum(is_space)]
+    
+    values = data.astype(np.uint64) * np.power(np.uint64(31), offsets.astype(np.uint64))
+    values[is_space] = 0
+    return (np.add.reduceat(values, starts) % np.uint64(50000)).astype(np.int32)
+
 class PreprocessorAgent:
     def __init__(self):
         self.supported_models = {
             'text_classifier': self._preprocess_text,
             'image_classifier': self._preprocess_image,
             'speech_to_text': self._preprocess_audio,
-            'llama2': self._preprocess_text,
-            'whisper': self._preprocess_audio,
-            'resnet50': self._preprocess_image
+            'llama2': self._preprocess_llama,
+            'whisper': self._preprocess_whisper,
+            'resnet50': self._preprocess_resnet50
         }
     
     async def preprocess(self, request: PreprocessRequest) -> PreprocessResponse:
@@ -59,139 +93,112 @@ class PreprocessorAgent:
             raise HTTPException(500, f"Preprocessing failed: {str(e)}")
     
     async def _preprocess_text(self, request: PreprocessRequest) -> Dict[str, Any]:
-        """Preprocess text data"""
-        text = request.data
+        """Preprocess text data for simple text classification"""
+        text = request.data.strip()
         
-        # Basic text preprocessing
-        text = text.strip()
+        # Mock embedding: byte values scaled to [0, 1], zero-padded to 512
+        embedding = np.zeros((1, 512), dtype=np.float32)
+        raw = np.frombuffer(text[:512].encode('latin-1', errors='replace'), dtype=np.uint8)
+        embedding[0, :raw.size] = raw
+        embedding *= 1.0 / 255.0
         
-        # For LLaMA-2, format as tokens (simplified)
-        if 'llama' in request.target_model.lower():
-            # Simple tokenization (in production, use proper tokenizer)
-            tokens = text.split()
-            token_ids = [hash(token) % 50000 for token in tokens]  # Mock tokenization
-            
-            return {
-                'INPUT_IDS': {
-                    'data': [token_ids],
-                    'shape': [1, len(token_ids)],
-                    'datatype': 'INT32'
-                },
-                'ATTENTION_MASK': {
-                    'data': [[1] * len(token_ids)],
-                    'shape': [1, len(token_ids)],
-                    'datatype': 'INT32'
-                }
-            }
-        else:
-            # For simple text classification
-            # Convert text to embedding (mock implementation)
-            embedding = [ord(c) / 255.0 for c in text[:512]]  # Mock embedding
-            embedding.extend([0.0] * (512 - len(embedding)))  # Pad to 512
+        return {
+            'INPUT': encode_tensor(embedding)
+        }
+    
+    async def _preprocess_llama(self, request: PreprocessRequest) -> Dict[str, Any]:
+        """Preprocess text data for LLaMA-2, formatted as tokens (simplified)"""
+        text = request.data.strip()
+        
+        # Simple tokenization (in production, use proper tokenizer)
+        tokens = text.split()
+        token_ids = _mock_token_ids(tokens)[None]  # Mock tokenization
+        
+        return {
+            'INPUT_IDS': encode_tensor(token_ids),
+            'ATTENTION_MASK': encode_tensor(np.ones_like(token_ids))
+        }
+    
+    async def _preprocess_image(self, request: PreprocessRequest) -> Dict[str, Any]:
+        """Preprocess image data for generic image classifiers"""
+        try:
+            image = cv2.resize(_decode_image(request.data), (256, 256), interpolation=cv2.INTER_LINEAR)
+            img_array = image.astype(np.float32) * (1.0 / 255.0)
+            img_array = np.expand_dims(img_array, axis=0)
             
             return {
-                'INPUT': {
-                    'data': [embedding],
-                    'shape': [1, 512],
-                    'datatype': 'FP32'
-                }
+                'INPUT': encode_tensor(img_array)
             }
+                
+        except Exception as e:
+            raise HTTPException(400, f"Invalid image data: {str(e)}")
     
-    async def _preprocess_image(self, request: PreprocessRequest) -> Dict[str, Any]:
-        """Preprocess image data"""
+    async def _preprocess_resnet50(self, request: PreprocessRequest) -> Dict[str, Any]:
+        """Preprocess image data for ResNet-50 (224x224, ImageNet-normalised NCHW)"""
         try:
-            # Decode base64 image
-            image_data = base64.b64decode(request.data)
-            image = Image.open(io.BytesIO(image_data))
+            image = cv2.resize(_decode_image(request.data), (224, 224), interpolation=cv2.INTER_LINEAR)
             
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            # ImageNet normalization in place on a single FP32 buffer
+            img_array = image.astype(np.float32)
+            img_array *= _INV_STD_255
+            img_array -= _MEAN_OVER_STD
             
-            # Resize to model requirements (ResNet-50 expects 224x224)
-            if 'resnet' in request.target_model.lower():
-                image = image.resize((224, 224))
-                
-                # Convert to numpy array and normalize
-                img_array = np.array(image).astype(np.float32)
-                img_array = img_array / 255.0  # Normalize to [0, 1]
-                
-                # ImageNet normalization
-                mean = np.array([0.485, 0.456, 0.406])
-                std = np.array([0.229, 0.224, 0.225])
-                img_array = (img_array - mean) / std
-                
-                # Add batch dimension and transpose to CHW format
-                img_array = np.transpose(img_array, (2, 0, 1))  # HWC to CHW
-                img_array = np.expand_dims(img_array, axis=0)   # Add batch dim
-                
-                return {
-                    'INPUT': {
-                        'data': img_array.tolist(),
-                        'shape': list(img_array.shape),
-                        'datatype': 'FP32'
-                    }
-                }
-            else:
-                # Generic image preprocessing
-                image = image.resize((256, 256))
-                img_array = np.array(image).astype(np.float32) / 255.0
-                img_array = np.expand_dims(img_array, axis=0)
-                
-                return {
-                    'INPUT': {
-                        'data': img_array.tolist(),
-                        'shape': list(img_array.shape),
-                        'datatype': 'FP32'
-                    }
-                }
+            # Transpose HWC to CHW and add batch dimension
+            img_array = np.ascontiguousarray(img_array.transpose(2, 0, 1))[None]
+            
+            return {
+                'INPUT': encode_tensor(img_array)
+            }
                 
         except Exception as e:
             raise HTTPException(400, f"Invalid image data: {str(e)}")
     
     async def _preprocess_audio(self, request: PreprocessRequest) -> Dict[str, Any]:
-        """Preprocess audio data"""
+        """Preprocess audio data into MFCC features"""
         try:
-            # Decode base64 audio
             audio_data = base64.b64decode(request.data)
             
-            # Load audio using librosa
-            audio_array, sr = librosa.load(io.BytesIO(audio_data), sr=16000)
-            
-            if 'whisper' in request.target_model.lower():
-                # Whisper expects specific format
-                # Pad or trim to 30 seconds at 16kHz
-                target_length = 30 * 16000
-                if len(audio_array) > target_length:
-                    audio_array = audio_array[:target_length]
-                else:
-                    audio_array = np.pad(audio_array, (0, target_length - len(audio_array)))
-                
-                # Add batch dimension
-                audio_array = np.expand_dims(audio_array, axis=0)
-                
-                return {
-                    'AUDIO': {
-                        'data': audio_array.tolist(),
-                        'shape': list(audio_array.shape),
-                        'datatype': 'FP32'
-                    }
-                }
-            else:
-                # Generic audio preprocessing - extract MFCC features
-                mfccs = librosa.feature.mfcc(y=audio_array, sr=sr, n_mfcc=13)
-                mfccs = np.expand_dims(mfccs.T, axis=0)  # Add batch dimension
+            # Decoding and feature extraction are CPU-bound; keep them off the event loop
+            return await asyncio.to_thread(self._process_audio, audio_data)
                 
-                return {
-                    'INPUT': {
-                        'data': mfccs.tolist(),
-                        'shape': list(mfccs.shape),
-                        'datatype': 'FP32'
-                    }
-                }
+        except Exception as e:
+            raise HTTPException(400, f"Invalid audio data: {str(e)}")
+    
+    async def _preprocess_whisper(self, request: PreprocessRequest) -> Dict[str, Any]:
+        """Preprocess audio data for Whisper"""
+        try:
+            audio_data = base64.b64decode(request.data)
+            return await asyncio.to_thread(self._process_whisper, audio_data)
                 
         except Exception as e:
             raise HTTPException(400, f"Invalid audio data: {str(e)}")
+    
+    def _process_audio(self, audio_data: bytes) -> Dict[str, Any]:
+        """Extract MFCC features (runs in a worker thread)"""
+        audio_array, sr = librosa.load(io.BytesIO(audio_data), sr=16000)
+        
+        mfccs = librosa.feature.mfcc(y=audio_array, sr=sr, n_mfcc=13)
+        mfccs = np.expand_dims(mfccs.T, axis=0)  # Add batch dimension
+        
+        return {
+            'INPUT': encode_tensor(mfccs.astype(np.float32, copy=False))
+        }
+    
+    def _process_whisper(self, audio_data: bytes) -> Dict[str, Any]:
+        """Pad or trim audio to Whisper's fixed input length (runs in a worker thread)"""
+        audio_array, _ = librosa.load(io.BytesIO(audio_data), sr=16000)
+        
+        if len(audio_array) > _WHISPER_TARGET_LENGTH:
+            audio_array = audio_array[:_WHISPER_TARGET_LENGTH]
+        else:
+            audio_array = np.pad(audio_array, (0, _WHISPER_TARGET_LENGTH - len(audio_array)))
+        
+        # Add batch dimension
+        audio_array = np.expand_dims(audio_array, axis=0)
+        
+        return {
+            'AUDIO': encode_tensor(audio_array.astype(np.float32, copy=False))
+        }
 
 # Global agent instance
 preprocessor = PreprocessorAgent()
@@ -0,0 +1 @@
+# agents/utils - Helpers shared by the agent services
@@ -0,0 +1,40 @@
+# agents/utils/tensors.py - Binary tensor payloads shared by all agents
+import base64
+import math
+from typing import Dict, Any, List
+import numpy as np
+
+# Triton datatype <-> numpy dtype
+TRITON_TO_NP_DTYPE = {
+    'FP16': np.float16,
+    'FP32': np.float32,
+    'FP64': np.float64,
+    'INT8': np.int8,
+    'INT16': np.int16,
+    'INT32': np.int32,
+    'INT64': np.int64,
+    'UINT8': np.uint8,
+    'UINT16': np.uint16,
+    'UINT32': np.uint32,
+    'UINT64': np.uint64,
+    'BOOL': np.bool_
+}
+NP_TO_TRITON_DTYPE = {np.dtype(dtype): datatype for datatype, dtype in TRITON_TO_NP_DTYPE.items()}
+
+def encode_tensor(array: np.ndarray) -> Dict[str, Any]:
+    """Encode a tensor as {'b64', 'shape', 'datatype'} with a Triton datatype name"""
+    array = np.ascontiguousarray(array)
+    return {
+        'b64': base64.b64encode(array.tobytes()).decode('ascii'),
+        'shape': list(array.shape),
+        'datatype': NP_TO_TRITON_DTYPE[array.dtype]
+    }
+
+def decode_tensor(b64: str, shape: List[int], datatype: str) -> np.ndarray:
+    """Decode a binary tensor payload back into a (read-only) numpy array"""
+    dtype = np.dtype(TRITON_TO_NP_DTYPE[datatype])
+    raw = base64.b64decode(b64, validate=True)
+    expected = math.prod(shape) * dtype.itemsize
+    if len(raw) != expected:
+        raise ValueError(f"payload has {len(raw)} bytes, shape {list(shape)} of {datatype} needs {expected}")
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
@@ -9,19 +9,20 @@ class TritonPythonModel:
         self.classifier = lambda x: [{"label": "POSITIVE", "score": 0.8}]
     
     def execute(self, requests):
+        # Get batch size of each request's input text
+        sizes = [pb_utils.get_input_tensor_by_name(request, "INPUT").as_numpy().shape[0]
+                 for request in requests]
+        
+        # Mock classification: one buffer for the whole dynamic batch
+        output_data = np.empty((sum(sizes), 2), dtype=np.float32)
+        output_data[:, 0] = 0.8  # Positive class
+        output_data[:, 1] = 0.2  # Negative class
+        
+        # Split back into per-request views
+        offsets = np.cumsum([0] + sizes)
         responses = []
-        for request in requests:
-            # Get input text
-            input_tensor = pb_utils.get_input_tensor_by_name(request, "INPUT")
-            text_input = input_tensor.as_numpy()
-            
-            # Mock classification
-            batch_size = text_input.shape[0]
-            output_data = np.random.rand(batch_size, 2).astype(np.float32)
-            output_data[:, 0] = 0.8  # Positive class
-            output_data[:, 1] = 0.2  # Negative class
-            
-            output_tensor = pb_utils.Tensor("OUTPUT", output_data)
+        for i in range(len(requests)):
+            output_tensor = pb_utils.Tensor("OUTPUT", output_data[offsets[i]:offsets[i + 1]])
             response = pb_utils.InferenceResponse(output_tensors=[output_tensor])
             responses.append(response)
         